@@ -0,0 +1,185 @@
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import coderunner
+
+SNIPPETS = {
+    'python': "import json\nprint(json.dumps({'sum': sum(range(1000))}))\n",
+    'javascript': "console.log(JSON.stringify({sum: [...Array(1000).keys()].reduce((a, b) => a + b, 0)}))\n",
+}
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {'mean': statistics.mean(samples), 'p50': pick(0.50), 'p90': pick(0.90), 'p99': pick(0.99)}
+
+def report(label, samples, unit=1000.0, suffix='ms'):
+    stats = percentiles(samples)
+    print(f"{label:<28} " + '  '.join(f"{k}={v * unit:8.2f}{suffix}" for k, v in stats.items()))
+
+def bench_pool(args):
+    for language in args.languages:
+        code = SNIPPETS[language]
+        fd, path = tempfile.mkstemp(suffix=coderunner.EXT_MAP[language])
+        with os.fdopen(fd, 'w') as f:
+            f.write(code)
+        cold = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run(coderunner.LANG_COMMANDS[language](path), capture_output=True, text=True)
+            cold.append(time.perf_counter() - start)
+        os.remove(path)
+
+        pool = coderunner.WorkerPool(language, args.size, args.max_runs)
+        pool.run(code)
+        warm = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            pool.run(code)
+            warm.append(time.perf_counter() - start)
+        pool.close()
+
+        report(f'{language} cold', cold)
+        report(f'{language} warm (pool)', warm)
+        print(f"{language} speedup (p50): {percentiles(cold)['p50'] / percentiles(warm)['p50']:.1f}x")
+
+# Each snippet prints a token that only appears in the output, never in the
+# echoed code, so a response can be matched to the request that produced it.
+TOKEN_SNIPPETS = {
+    'python': "print('run-' + str({n} * 3))",
+    'javascript': "console.log('run-' + ({n} * 3))",
+    'bash': "echo run-$(({n} * 3))",
+}
+
+def post(url, language, code):
+    data = urllib.parse.urlencode({'language': language, 'code': code}).encode()
+    start = time.perf_counter()
+    with urllib.request.urlopen(url, data=data, timeout=120) as resp:
+        body = resp.read().decode()
+    return time.perf_counter() - start, body
+
+def run_load(url, requests, concurrency, languages=tuple(TOKEN_SNIPPETS)):
+    def one(n):
+        language = languages[n % len(languages)]
+        try:
+            elapsed, body = post(url, language, TOKEN_SNIPPETS[language].format(n=n))
+        except urllib.error.HTTPError as e:
+            return n, None, e.code
+        return n, elapsed, re.findall(r'run-(\d+)', body)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    return results, time.perf_counter() - start
+
+def summarize(label, results, total, concurrency):
+    ok = [r for r in results if r[1] is not None]
+    rejected = len(results) - len(ok)
+    if ok:
+        report(f'{label} latency', [elapsed for _, elapsed, _ in ok])
+    print(f"{label}: {len(ok)} ok, {rejected} rejected (503), concurrency {concurrency}: {len(ok) / total:.1f} req/s")
+    return [n for n, elapsed, tokens in ok if tokens != [str(n * 3)]]
+
+def bench_load(args):
+    results, total = run_load(args.url, args.requests, args.concurrency)
+    mismatched = summarize('load', results, total, args.concurrency)
+    if mismatched:
+        print(f"FAIL: {len(mismatched)} responses did not match their own input, e.g. #{mismatched[0]}")
+        return 1
+    print("OK: every response matched its own input")
+
+def wait_for(url, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'server exited with status {proc.returncode}')
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server at {url} did not come up within {timeout}s')
+
+def bench_serve(args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'coderunner.py')
+    modes = {
+        'dev': [sys.executable, script],
+        'production': [sys.executable, script, 'serve', '--host', '127.0.0.1', '--port', str(args.port)]
+                      + args.serve_args,
+    }
+    for label, cmd in modes.items():
+        url = f'http://127.0.0.1:{args.port}/'
+        env = dict(os.environ, CODERUNNER_PORT=str(args.port))
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for(url, proc)
+            run_load(url, min(args.requests, args.concurrency), args.concurrency, args.languages)
+            results, total = run_load(url, args.requests, args.concurrency, args.languages)
+            summarize(label, results, total, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+def bench_page(args):
+    ttfb, body = [], ''
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        with urllib.request.urlopen(args.url, timeout=30) as resp:
+            resp.read(1)
+            ttfb.append(time.perf_counter() - start)
+            body = resp.read().decode()
+    report('GET / time to first byte', ttfb)
+    weight = len(body.encode())
+    for link in re.findall(r'<(?:link[^>]+href|script[^>]+src)="([^"]+)"', body):
+        req = urllib.request.Request(urllib.parse.urljoin(args.url, link), headers={'Accept-Encoding': 'gzip'})
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            size = len(resp.read())
+        print(f"  {link}: {size} bytes on the wire")
+        weight += size
+    print(f"page weight: {weight} bytes (HTML + linked assets)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Code Runner benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    pool = sub.add_parser('pool', help='cold interpreter spawn vs pre-warmed worker pool')
+    pool.add_argument('--languages', nargs='+', default=list(SNIPPETS), choices=list(SNIPPETS))
+    pool.add_argument('--runs', type=int, default=50)
+    pool.add_argument('--size', type=int, default=1)
+    pool.add_argument('--max-runs', type=int, default=coderunner.POOL_MAX_RUNS)
+    pool.set_defaults(func=bench_pool)
+
+    load = sub.add_parser('load', help='fire parallel POSTs at a running server and check every output')
+    load.add_argument('--url', default='http://127.0.0.1:6767/')
+    load.add_argument('--requests', '-n', type=int, default=300)
+    load.add_argument('--concurrency', '-c', type=int, default=100)
+    load.set_defaults(func=bench_load)
+
+    page = sub.add_parser('page', help='time to first byte and page weight of the form page')
+    page.add_argument('--url', default='http://127.0.0.1:6767/')
+    page.add_argument('--runs', type=int, default=200)
+    page.set_defaults(func=bench_page)
+
+    serve = sub.add_parser('serve', help='requests/sec and latency of the dev server vs the production serve mode')
+    serve.add_argument('--port', type=int, default=6799)
+    serve.add_argument('--requests', '-n', type=int, default=500)
+    serve.add_argument('--concurrency', '-c', type=int, default=32)
+    serve.add_argument('--languages', nargs='+', default=['python'], choices=list(TOKEN_SNIPPETS))
+    serve.add_argument('serve_args', nargs='*', help='extra flags for coderunner.py serve (after --)')
+    serve.set_defaults(func=bench_serve)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,37 @@
+import argparse
 import subprocess
 import sys
 import os
-from flask import Flask, render_template_string, request
+import json
+import asyncio
+import bisect
+import codecs
+import collections
+import functools
+import gzip
+import glob
+import hashlib
+import importlib.util
+import io
+import itertools
+import pstats
+import time
+import uuid
+import contextlib
+import tempfile
+import queue
+import signal
+import select
+import selectors
+import shutil
+import socket
+import threading
+try:
+    import resource
+except ImportError:
+    resource = None
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, jsonify, request, stream_with_context, url_for
 
 LANG_COMMANDS = {
     'python': lambda file: ['python3', file],
@@ -21,19 +51,1456 @@ EXT_MAP = {
     'css': '.css',
 }
 
+LIMITS = {
+    'timeout': float(os.environ.get('CODERUNNER_TIMEOUT', '10')),
+    'cpu': int(os.environ.get('CODERUNNER_CPU_LIMIT', '10')),
+    'memory': int(os.environ.get('CODERUNNER_MEMORY_LIMIT', str(512 * 1024 * 1024))),
+    # Processes and threads a run may add on top of what the uid already has.
+    'nproc': int(os.environ.get('CODERUNNER_NPROC_LIMIT', '256')),
+    'output': int(os.environ.get('CODERUNNER_OUTPUT_LIMIT', str(1024 * 1024))),
+}
+
+# V8 reserves far more address space than it ever touches, so node is held
+# to a heap size instead of RLIMIT_AS.
+LANG_LIMITS = {
+    'javascript': {'memory': 0, 'heap_mb': 256},
+}
+
+TRUNCATION_MARKER = '\n[output truncated]\n'
+
+def limits_for(language):
+    limits = dict(LIMITS, **LANG_LIMITS.get(language, {}))
+    timeout = os.environ.get(f'CODERUNNER_TIMEOUT_{language.upper()}')
+    if timeout:
+        limits['timeout'] = float(timeout)
+    return limits
+
+# RLIMIT_NPROC counts every process and thread the uid owns, not those of
+# one run, so a fixed value either starves a busy server (pool workers,
+# request threads) or does nothing. Each run instead gets the uid's current
+# count plus LIMITS['nproc'] of headroom, which still stops a fork bomb.
+# A cgroup pids.max or a dedicated uid per run would be exact but needs
+# privileges this process does not assume. Root ignores RLIMIT_NPROC, so
+# run the server as an unprivileged user for this limit to apply.
+_uid_tasks = (0.0, 0)
+_uid_tasks_lock = threading.Lock()
+
+def uid_tasks(ttl=1.0):
+    global _uid_tasks
+    now = time.monotonic()
+    with _uid_tasks_lock:
+        if now - _uid_tasks[0] < ttl:
+            return _uid_tasks[1]
+        uid = os.getuid()
+        count = 0
+        with contextlib.suppress(OSError):
+            for entry in os.scandir('/proc'):
+                if not entry.name.isdigit():
+                    continue
+                with contextlib.suppress(OSError):
+                    if entry.stat().st_uid == uid:
+                        count += len(os.listdir(os.path.join(entry.path, 'task')))
+        _uid_tasks = (now, count)
+        return count
+
+def rlimit_table(limits):
+    # SIGXCPU at the soft CPU limit, SIGKILL a second later.
+    table = []
+    if resource is None:
+        return table
+    if limits.get('cpu'):
+        table.append((resource.RLIMIT_CPU, limits['cpu'], limits['cpu'] + 1))
+    if limits.get('memory'):
+        table.append((resource.RLIMIT_AS, limits['memory'], limits['memory']))
+    if limits.get('nproc'):
+        nproc = uid_tasks() + limits['nproc']
+        table.append((resource.RLIMIT_NPROC, nproc, nproc))
+    clamped = []
+    for which, soft, hard in table:
+        ceiling = resource.getrlimit(which)[1]
+        if ceiling != resource.RLIM_INFINITY:
+            soft, hard = min(soft, ceiling), min(hard, ceiling)
+        clamped.append((which, soft, hard))
+    return clamped
+
+
+def breached_limit(returncode, stderr, limits, cpu_time=None):
+    if returncode is None or returncode == 0:
+        return None
+    if returncode == -signal.SIGXCPU or (returncode == -signal.SIGKILL and cpu_time and limits.get('cpu')
+                                         and cpu_time >= limits['cpu']):
+        return 'cpu'
+    if returncode == -signal.SIGXFSZ:
+        return 'output'
+    if 'MemoryError' in stderr or 'out of memory' in stderr or 'ERR_WORKER_OUT_OF_MEMORY' in stderr:
+        return 'memory'
+    if 'Resource temporarily unavailable' in stderr:
+        return 'nproc'
+    return None
+
+def kill_group(pid):
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        os.killpg(pid, signal.SIGKILL)
+
+POOL_SIZE = int(os.environ.get('CODERUNNER_POOL_SIZE', str(os.cpu_count() or 2)))
+POOL_MAX_RUNS = int(os.environ.get('CODERUNNER_POOL_MAX_RUNS', '100'))
+POOL_WAIT = float(os.environ.get('CODERUNNER_POOL_WAIT', '5'))
+
+# Python workers fork a fresh child per job so every snippet gets a clean
+# namespace but skips interpreter startup and the warm stdlib imports.
+PY_WORKER = r"""
+import atexit, json, os, resource, select, signal, socket, sys, tempfile, time, traceback, types
+import collections, itertools, functools, math, random, re
+
+def wait(pid, timeout):
+    deadline = time.monotonic() + timeout if timeout else None
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    try:
+        while True:
+            done, status, usage = os.wait4(pid, os.WNOHANG if deadline else 0)
+            if done:
+                return status, usage, False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                os.killpg(pid, signal.SIGKILL)
+                _, status, usage = os.wait4(pid, 0)
+                return status, usage, True
+            if pidfd is not None:
+                select.select([pidfd], [], [], remaining)
+            else:
+                time.sleep(min(remaining, 0.01))
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+# Anonymous memory files keep the per-job stdio off the disk; RLIMIT_FSIZE
+# applies to them all the same.
+def scratch():
+    if hasattr(os, 'memfd_create'):
+        return open(os.memfd_create('io'), 'w+b')
+    return tempfile.TemporaryFile()
+
+worker_fd = int(os.environ.pop('CODERUNNER_WORKER_FD'))
+sock = socket.socket(fileno=worker_fd)
+jobs, proto = sock.makefile('r'), sock.makefile('w')
+for line in jobs:
+    job = json.loads(line)
+    out, err, inp = scratch(), scratch(), scratch()
+    inp.write(job.get('stdin', '').encode()); inp.seek(0)
+    forked = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        # The makefiles keep the socket object alive, so close the fd itself.
+        os.close(worker_fd)
+        os.setsid()
+        # Output goes to files, so RLIMIT_FSIZE is the output cap.
+        signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+        for which, soft, hard in job['rlimits']:
+            resource.setrlimit(which, (soft, hard))
+        os.dup2(inp.fileno(), 0); os.dup2(out.fileno(), 1); os.dup2(err.fileno(), 2)
+        sys.stdin = open(0, closefd=False)
+        filename = job.get('filename') or '<code>'
+        sys.argv = [filename]
+        if job.get('filename'):
+            sys.path[0] = os.path.dirname(os.path.abspath(filename))
+        # A real __main__ module, so pickle (and multiprocessing) can find
+        # what the snippet defines, as on a cold run.
+        main = types.ModuleType('__main__')
+        main.__file__ = filename
+        main.__builtins__ = __builtins__
+        sys.modules['__main__'] = main
+        status = 0
+        try:
+            exec(compile(job['code'], filename, 'exec'), main.__dict__)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except BaseException as e:
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            status = 1
+        # What interpreter shutdown would do before os._exit() skips it:
+        # wait for non-daemon threads, then run atexit handlers.
+        if 'threading' in sys.modules:
+            sys.modules['threading']._shutdown()
+        atexit._run_exitfuncs()
+        sys.stdout.flush(); sys.stderr.flush()
+        os._exit(status)
+    spawn_time = time.perf_counter() - forked
+    status, usage, timed_out = wait(pid, job['timeout'])
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    out.seek(0); err.seek(0)
+    proto.write(json.dumps({'stdout': out.read().decode(errors='replace'), 'stderr': err.read().decode(errors='replace'), 'returncode': os.waitstatus_to_exitcode(status), 'id': job['id'],
+                            'cpu_time': usage.ru_utime + usage.ru_stime, 'max_rss_kb': usage.ru_maxrss, 'spawn_time': spawn_time,
+                            'limit': 'timeout' if timed_out else None}) + '\n')
+    proto.flush()
+    out.close(); err.close(); inp.close()
+"""
+
+# Node has no fork(), so each job runs in its own worker thread (a fresh V8
+# isolate) inside a long-lived node process. A worker thread holding unread
+# stdin never exits, so jobs with stdin are left to a cold spawn.
+# A thread printing in a tight loop only flushes when it yields, so the heap
+# limit and the timeout bound those rather than the output cap.
+NODE_WORKER = r"""
+const net = require('net');
+const readline = require('readline');
+const { Worker } = require('worker_threads');
+const sock = new net.Socket({ fd: Number(process.env.CODERUNNER_WORKER_FD), readable: true, writable: true });
+// Worker threads copy process.env, so snippets never learn the fd.
+delete process.env.CODERUNNER_WORKER_FD;
+const rl = readline.createInterface({ input: sock });
+rl.on('line', (line) => {
+    const job = JSON.parse(line);
+    const limits = job.limits;
+    const started = process.hrtime.bigint();
+    let spawn = null;
+    // Files load by path so relative require() and __filename work.
+    const w = new Worker(job.filename || job.code, {
+        eval: !job.filename, stdout: true, stderr: true,
+        resourceLimits: limits.heap_mb ? { maxOldGenerationSizeMb: limits.heap_mb } : {},
+    });
+    let out = '', err = '', size = 0, limit = null;
+    // Jobs run one at a time per worker, so the process's CPU delta is the
+    // job's (plus its thread startup). Peak RSS is the worker process's
+    // high-water mark so far; a thread has no RSS of its own.
+    const cpu = process.cpuUsage();
+    const stop = (reason) => { limit = limit || reason; w.terminate(); };
+    const capture = (append) => (d) => {
+        size += d.length;
+        if (limits.output && size > limits.output) {
+            stop('output');
+        } else {
+            append(String(d));
+        }
+    };
+    const timer = limits.timeout ? setTimeout(() => stop('timeout'), limits.timeout * 1000) : null;
+    w.on('online', () => { spawn = Number(process.hrtime.bigint() - started) / 1e9; });
+    w.stdout.on('data', capture((d) => { out += d; }));
+    w.stderr.on('data', capture((d) => { err += d; }));
+    w.on('error', (e) => {
+        if (e && e.code === 'ERR_WORKER_OUT_OF_MEMORY') {
+            limit = limit || 'memory';
+        }
+        err += (e && e.stack ? e.stack : String(e)) + '\n';
+    });
+    const ended = (s) => new Promise((resolve) => s.on('end', resolve));
+    const exited = new Promise((resolve) => w.on('exit', resolve));
+    Promise.all([exited, ended(w.stdout), ended(w.stderr)]).then(([code]) => {
+        clearTimeout(timer);
+        const used = process.cpuUsage(cpu);
+        sock.write(JSON.stringify({
+            id: job.id, stdout: out, stderr: err, returncode: code, limit: limit, spawn_time: spawn,
+            cpu_time: (used.user + used.system) / 1e6, max_rss_kb: process.resourceUsage().maxRSS,
+        }) + '\n');
+    });
+});
+"""
+
+POOL_COMMANDS = {
+    'python': ['python3', '-c', PY_WORKER],
+    'javascript': ['node', '-e', NODE_WORKER],
+}
+
+POOL_STDIN_LANGUAGES = {'python'}
+
+# Node snippets run in the worker's own process group, so anything they
+# started is only killed by recycling the worker (close() kills the group).
+RECYCLE_ON_LIMIT = {'javascript'}
+
+class Worker:
+    def __init__(self, language):
+        self.language = language
+        self.runs = 0
+        # Jobs travel over a dedicated socket so snippets reading fd 0 or
+        # writing fd 1 directly cannot see or corrupt the protocol stream.
+        ours, theirs = socket.socketpair()
+        env = dict(os.environ, CODERUNNER_WORKER_FD=str(theirs.fileno()))
+        # Snippets run inside (node) or forked from (python) the worker, so
+        # it gets its own process group. The process-count limit is set per
+        # job, never on the worker itself.
+        self.proc = subprocess.Popen(POOL_COMMANDS[language], stdin=subprocess.DEVNULL,
+                                     pass_fds=(theirs.fileno(),), env=env, start_new_session=True)
+        theirs.close()
+        self.sock = ours
+        self.jobs = ours.makefile('w')
+        self.results = ours.makefile('r')
+
+    def run(self, code, stdin='', limits=LIMITS, filename=None):
+        table = rlimit_table(limits)
+        if limits.get('output') and resource is not None:
+            table.append((resource.RLIMIT_FSIZE, limits['output'], limits['output']))
+        job = {'id': uuid.uuid4().hex, 'code': code, 'filename': filename, 'stdin': stdin, 'timeout': limits.get('timeout'), 'limits': limits, 'rlimits': table}
+        # The worker enforces the timeout itself; this only catches a hung worker.
+        self.sock.settimeout(limits['timeout'] + 5 if limits.get('timeout') else None)
+        self.jobs.write(json.dumps(job) + '\n')
+        self.jobs.flush()
+        line = self.results.readline()
+        if not line:
+            raise RuntimeError(f'{self.language} worker exited with status {self.proc.wait()}')
+        self.runs += 1
+        result = json.loads(line)
+        # Node snippets share the worker's fd table, so a forged reply is
+        # possible there; it cannot know the job id.
+        if not isinstance(result, dict) or result.pop('id', None) != job['id']:
+            raise RuntimeError(f'{self.language} worker sent a reply for another job')
+        return result
+
+    def close(self):
+        kill_group(self.proc.pid)
+        self.proc.wait()
+        self.jobs.close()
+        self.results.close()
+        self.sock.close()
+
+class WorkerPool:
+    def __init__(self, language, size=POOL_SIZE, max_runs=POOL_MAX_RUNS):
+        self.language = language
+        self.max_runs = max_runs
+        self.idle = queue.Queue()
+        self.size = size
+        self.lock = threading.Lock()
+        try:
+            for _ in range(size):
+                self.idle.put(Worker(language))
+        except OSError:
+            self.close()
+            raise
+
+    def _replace(self, worker):
+        worker.close()
+        try:
+            self.idle.put(Worker(self.language))
+        except OSError as e:
+            with self.lock:
+                self.size -= 1
+            print(f"{self.language} pool: could not start a worker ({e}); {self.size} left", file=sys.stderr)
+
+    # Returns None when no worker is free in time (or none are left), and
+    # the caller falls back to a cold spawn.
+    def run(self, code, stdin='', filename=None):
+        limits = limits_for(self.language)
+        waited = time.perf_counter()
+        if not self.size:
+            return None
+        try:
+            worker = self.idle.get(timeout=POOL_WAIT)
+        except queue.Empty:
+            return None
+        start = time.perf_counter()
+        try:
+            result = worker.run(code, stdin, limits, filename)
+            result['wall_time'] = time.perf_counter() - start
+        except (OSError, ValueError, RuntimeError) as e:
+            threading.Thread(target=self._replace, args=(worker,), daemon=True).start()
+            return {'stdout': '', 'stderr': f'Worker crashed: {e}', 'returncode': None, 'limit': None,
+                    'cpu_time': None, 'max_rss_kb': None,
+                    'queue_wait': start - waited}
+        result['queue_wait'] = start - waited
+        result['limit'] = result.get('limit') or breached_limit(result['returncode'], result['stderr'], limits,
+                                                                 result.get('cpu_time'))
+        if result['limit'] == 'output':
+            result['truncated'] = True
+            result['stderr'] += TRUNCATION_MARKER
+        if worker.runs >= self.max_runs or (result['limit'] and self.language in RECYCLE_ON_LIMIT):
+            threading.Thread(target=self._replace, args=(worker,), daemon=True).start()
+        else:
+            self.idle.put(worker)
+        return result
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+_pools = {}
+
+def get_pool(language, stdin=''):
+    if stdin and language not in POOL_STDIN_LANGUAGES:
+        return None
+    return _pools.get(language)
+
+def start_pools(size=POOL_SIZE, max_runs=POOL_MAX_RUNS):
+    if size <= 0:
+        return
+    for language, cmd in POOL_COMMANDS.items():
+        # Languages whose interpreter is missing just run cold (and fail there).
+        if language in _pools or shutil.which(cmd[0]) is None:
+            continue
+        try:
+            _pools[language] = WorkerPool(language, size, max_runs)
+        except OSError as e:
+            print(f"{language} pool not started: {e}", file=sys.stderr)
+
+def stop_pools():
+    while _pools:
+        _pools.popitem()[1].close()
+
+# Interpreters that can read their program from an anonymous memfd; the rest
+# get a private directory on tmpfs so concurrent runs never share a path.
+MEMFD_LANGUAGES = {'python', 'bash'} if hasattr(os, 'memfd_create') else set()
+WORKSPACE_ROOT = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+
+@contextlib.contextmanager
+def source_file(language, code, named=False):
+    if language in MEMFD_LANGUAGES and not named:
+        fd = os.memfd_create('code')
+        try:
+            with open(fd, 'w', closefd=False) as f:
+                f.write(code)
+            os.lseek(fd, 0, os.SEEK_SET)
+            yield f'/dev/fd/{fd}', (fd,)
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.TemporaryDirectory(prefix='coderunner-', dir=WORKSPACE_ROOT) as workspace:
+            path = os.path.join(workspace, 'main' + EXT_MAP.get(language, '.txt'))
+            with open(path, 'w') as f:
+                f.write(code)
+            yield path, ()
+
+# The run ends when the program exits, not when its pipes close: a
+# background child can hold them open, and a program can close them and
+# keep running. One deadline covers both the pipes and the reap.
+def collect(proc, stdin, timeout=None, max_output=None):
+    out, err = [], []
+    chunks = {proc.stdout.fileno(): out, proc.stderr.fileno(): err}
+    deadline = time.monotonic() + timeout if timeout else None
+    size = 0
+    streams = 2
+    reaped = None
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    with selectors.DefaultSelector() as sel:
+        sel.register(proc.stdout, selectors.EVENT_READ)
+        sel.register(proc.stderr, selectors.EVENT_READ)
+        if pidfd is not None:
+            sel.register(pidfd, selectors.EVENT_READ)
+        if stdin:
+            sel.register(proc.stdin, selectors.EVENT_WRITE)
+        else:
+            proc.stdin.close()
+        try:
+            while streams or reaped is None:
+                if reaped is None:
+                    pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                    if pid:
+                        reaped = status, usage
+                        # Whatever it left running goes too, so the pipes close.
+                        kill_group(proc.pid)
+                        if pidfd is not None:
+                            sel.unregister(pidfd)
+                        continue
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return b''.join(out), b''.join(err), 'timeout', reaped
+                if pidfd is None and reaped is None:
+                    remaining = min(remaining, 0.01) if remaining is not None else 0.01
+                for key, _ in sel.select(remaining):
+                    if key.fileobj == pidfd:
+                        continue
+                    if key.fileobj is proc.stdin:
+                        try:
+                            stdin = stdin[os.write(key.fd, stdin[:select.PIPE_BUF]):]
+                        except BrokenPipeError:
+                            stdin = b''
+                        if not stdin:
+                            sel.unregister(proc.stdin)
+                            proc.stdin.close()
+                        continue
+                    data = os.read(key.fd, 32768)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                        streams -= 1
+                        continue
+                    if max_output and size + len(data) > max_output:
+                        chunks[key.fd].append(data[:max_output - size])
+                        return b''.join(out), b''.join(err), 'output', reaped
+                    size += len(data)
+                    chunks[key.fd].append(data)
+        finally:
+            for key in list(sel.get_map().values()):
+                if key.fileobj != pidfd:
+                    key.fileobj.close()
+            if pidfd is not None:
+                os.close(pidfd)
+    return b''.join(out), b''.join(err), None, reaped
+
+PRLIMIT = shutil.which('prlimit')
+PRLIMIT_FLAGS = {
+    resource.RLIMIT_CPU: '--cpu',
+    resource.RLIMIT_AS: '--as',
+    resource.RLIMIT_NPROC: '--nproc',
+    resource.RLIMIT_FSIZE: '--fsize',
+} if resource is not None else {}
+
+RLIMIT_SHIM = '''
+import os, resource, sys
+for spec in sys.argv[1].split(','):
+    which, soft, hard = map(int, spec.split(':'))
+    resource.setrlimit(which, (soft, hard))
+os.execvp(sys.argv[2], sys.argv[2:])
+'''
+
+# preexec_fn can deadlock a child forked from a threaded server, so the
+# rlimits are set by a wrapper that then execs the interpreter: prlimit
+# where util-linux has it, a bare python3 -c shim otherwise.
+def with_rlimits(cmd, table):
+    if not table:
+        return list(cmd)
+    if PRLIMIT:
+        return [PRLIMIT] + [f'{PRLIMIT_FLAGS[which]}={soft}:{hard}' for which, soft, hard in table] + ['--'] + list(cmd)
+    spec = ','.join(f'{which}:{soft}:{hard}' for which, soft, hard in table)
+    return [sys.executable, '-S', '-c', RLIMIT_SHIM, spec] + list(cmd)
+
+# Everything a snippet is launched with, for spawn() and the job supervisor
+# alike: its own session (so the group can be killed), the heap limit and
+# the rlimits.
+def launch(cmd, limits, pass_fds=()):
+    env = None
+    if limits.get('heap_mb'):
+        env = dict(os.environ, NODE_OPTIONS=f"--max-old-space-size={limits['heap_mb']}")
+    return with_rlimits(cmd, rlimit_table(limits)), {
+        'stdin': subprocess.PIPE, 'stdout': subprocess.PIPE, 'stderr': subprocess.PIPE,
+        'pass_fds': pass_fds, 'env': env, 'start_new_session': True,
+    }
+
+def spawn(cmd, stdin='', pass_fds=(), limits=LIMITS):
+    start = time.perf_counter()
+    argv, options = launch(cmd, limits, pass_fds)
+    proc = subprocess.Popen(argv, **options)
+    spawn_time = time.perf_counter() - start
+    if not hasattr(os, 'wait4'):
+        limit = None
+        try:
+            out, err = proc.communicate(stdin.encode(), timeout=limits.get('timeout') or None)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            out, err = proc.communicate()
+            limit = 'timeout'
+        return {'stdout': out.decode(errors='replace'), 'stderr': err.decode(errors='replace'),
+                'returncode': proc.returncode, 'cmd': cmd, 'wall_time': time.perf_counter() - start,
+                'spawn_time': spawn_time, 'cpu_time': None, 'max_rss_kb': None, 'limit': limit}
+    out, err, limit, reaped = collect(proc, stdin.encode(), limits.get('timeout'), limits.get('output'))
+    if reaped is None:
+        kill_group(proc.pid)
+        # Reap the child ourselves so its rusage is not lost to Popen.wait().
+        _, status, usage = os.wait4(proc.pid, 0)
+    else:
+        status, usage = reaped
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # Anything the program left running in its group goes too.
+    kill_group(proc.pid)
+    err = err.decode(errors='replace')
+    cpu_time = usage.ru_utime + usage.ru_stime
+    limit = limit or breached_limit(proc.returncode, err, limits, cpu_time)
+    if limit == 'output':
+        err += TRUNCATION_MARKER
+    return {'stdout': out.decode(errors='replace'), 'stderr': err, 'returncode': proc.returncode, 'cmd': cmd,
+            'wall_time': time.perf_counter() - start, 'spawn_time': spawn_time, 'cpu_time': cpu_time,
+            'max_rss_kb': usage.ru_maxrss, 'limit': limit, 'truncated': limit == 'output'}
+
+VERSION_COMMANDS = {
+    'batch': ['cmd', '/c', 'ver'],
+}
+
+@functools.lru_cache(maxsize=None)
+def interpreter_version(language):
+    cmd = VERSION_COMMANDS.get(language) or [LANG_COMMANDS.get(language, lambda f: ['cat', f])('')[0], '--version']
+    try:
+        result = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return ''
+    return (result.stdout or result.stderr).strip()
+
+CACHE_DIR = os.environ.get('CODERUNNER_CACHE_DIR')
+CACHE_ENABLED = os.environ.get('CODERUNNER_CACHE', '1' if CACHE_DIR else '0') == '1'
+CACHE_ENTRIES = int(os.environ.get('CODERUNNER_CACHE_ENTRIES', '1024'))
+CACHE_DISK_BYTES = int(os.environ.get('CODERUNNER_CACHE_DISK_BYTES', str(64 * 1024 * 1024)))
+CACHE_TTL = int(os.environ.get('CODERUNNER_CACHE_TTL', '3600'))
+
+# Results keyed by a hash of (language, interpreter version, code, stdin):
+# an LRU in memory in front of an optional directory of JSON files.
+class ResultCache:
+    def __init__(self, max_entries=CACHE_ENTRIES, directory=None, max_bytes=CACHE_DISK_BYTES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_bytes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_bytes = sum(e.stat().st_size for e in os.scandir(directory) if e.name.endswith('.json'))
+
+    def key(self, language, code, stdin=''):
+        payload = json.dumps([language, interpreter_version(language), code, stdin])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def cacheable(self, result):
+        return result.get('returncode') is not None and not result.get('limit') and not result.get('truncated')
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(entry[1], cached=True)
+                del self.entries[key]
+        if self.directory:
+            try:
+                with open(os.path.join(self.directory, key + '.json')) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry is not None and entry['expires'] > now:
+                with self.lock:
+                    self._remember(key, entry['expires'], entry['result'])
+                    self.hits += 1
+                    self.disk_hits += 1
+                return dict(entry['result'], cached=True)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, expires, result):
+        self.entries[key] = (expires, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, key, result):
+        if not self.cacheable(result):
+            return
+        result = {k: result[k] for k in ('stdout', 'stderr', 'returncode')}
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, expires, result)
+        if self.directory:
+            data = json.dumps({'expires': expires, 'result': result})
+            path = os.path.join(self.directory, key + '.json')
+            tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, path)
+            with self.lock:
+                self.disk_bytes += len(data)
+                over = self.disk_bytes > self.max_bytes
+            if over:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        # Drop expired files, then the least recently written, down to 90%.
+        now = time.time()
+        files = []
+        for e in os.scandir(self.directory):
+            if e.name.endswith('.json'):
+                st = e.stat()
+                files.append((st.st_mtime, st.st_size, e.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for mtime, size, path in files:
+            if total <= self.max_bytes * 0.9 and mtime + self.ttl > now:
+                continue
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                total -= size
+        with self.lock:
+            self.disk_bytes = total
+
+    def stats(self):
+        with self.lock:
+            return {'enabled': True, 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'disk_bytes': self.disk_bytes}
+
+_cache = ResultCache(directory=CACHE_DIR) if CACHE_ENABLED else None
+
+def cache_stats():
+    return _cache.stats() if _cache is not None else {'enabled': False}
+
+# Upper bounds of each histogram's buckets, in the unit its name ends with.
+METRIC_BUCKETS = {
+    'queue_wait_seconds': (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+    'spawn_seconds': (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+    'run_seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'cpu_seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'max_rss_bytes': tuple(2 ** n * 1024 * 1024 for n in range(11)),
+    'output_bytes': (0, 64, 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024),
+}
+
+METRIC_HELP = {
+    'queue_wait_seconds': 'Time spent waiting for a pooled worker or the job loop.',
+    'spawn_seconds': 'Time to start the interpreter, fork the worker child or start the worker thread.',
+    'run_seconds': 'Wall-clock duration of a run.',
+    'cpu_seconds': 'User plus system CPU time of a run.',
+    'max_rss_bytes': 'Peak resident set size of a run.',
+    'output_bytes': 'Combined stdout and stderr size of a run.',
+    'runs_total': 'Runs executed (cache hits excluded).',
+    'errors_total': 'Runs that exited non-zero or could not be started.',
+    'timeouts_total': 'Runs stopped by the wall-clock timeout.',
+    'limit_breaches_total': 'Runs stopped by a resource limit.',
+    'cache_hits_total': 'Runs answered from the result cache.',
+    'cache_misses_total': 'Result cache lookups that had to run the code.',
+    'cache_entries': 'Results held in the in-memory cache.',
+    'inflight_executions': 'Executions running or waiting for a worker.',
+    'pool_idle_workers': 'Pooled workers waiting for a job.',
+}
+
+def metric_family(name, kind, samples):
+    lines = [f'# HELP coderunner_{name} {METRIC_HELP[name]}', f'# TYPE coderunner_{name} {kind}']
+    for suffix, labels, value in samples:
+        label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f'coderunner_{name}{suffix}{{{label_text}}} {value}' if label_text else
+                     f'coderunner_{name}{suffix} {value}')
+    return lines
+
+# Per-language histograms and counters for every run, kept per process.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.Counter()
+
+    def observe(self, name, language, value):
+        if value is None:
+            return
+        bounds = METRIC_BUCKETS[name]
+        index = bisect.bisect_left(bounds, value)
+        with self.lock:
+            hist = self.histograms.get((name, language))
+            if hist is None:
+                hist = self.histograms[(name, language)] = {'buckets': [0] * len(bounds), 'sum': 0, 'count': 0}
+            if index < len(bounds):
+                hist['buckets'][index] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def inc(self, name, language, limit=None):
+        with self.lock:
+            self.counters[(name, language, limit)] += 1
+
+    def record(self, language, result):
+        # Arbitrary form input must not turn into unbounded label values.
+        language = language if language in LANG_COMMANDS else 'other'
+        self.inc('runs_total', language)
+        if result.get('returncode') != 0:
+            self.inc('errors_total', language)
+        if result.get('limit') == 'timeout':
+            self.inc('timeouts_total', language)
+        if result.get('limit'):
+            self.inc('limit_breaches_total', language, result['limit'])
+        rss = result.get('max_rss_kb')
+        self.observe('queue_wait_seconds', language, result.get('queue_wait'))
+        self.observe('spawn_seconds', language, result.get('spawn_time'))
+        self.observe('run_seconds', language, result.get('wall_time'))
+        self.observe('cpu_seconds', language, result.get('cpu_time'))
+        self.observe('max_rss_bytes', language, rss * 1024 if rss is not None else None)
+        self.observe('output_bytes', language,
+                     len(result.get('stdout', '').encode()) + len(result.get('stderr', '').encode()))
+
+    def _copy(self):
+        with self.lock:
+            histograms = {k: dict(v, buckets=list(v['buckets'])) for k, v in self.histograms.items()}
+            return histograms, dict(self.counters)
+
+    def prometheus(self):
+        histograms, counters = self._copy()
+        lines = []
+        for name in sorted({name for name, _, _ in counters}):
+            samples = []
+            for (counter, language, limit), value in sorted(counters.items(), key=str):
+                if counter == name:
+                    labels = [('language', language)] + ([('limit', limit)] if limit else [])
+                    samples.append(('', labels, value))
+            lines += metric_family(name, 'counter', samples)
+        for name, bounds in METRIC_BUCKETS.items():
+            samples = []
+            for (hist_name, language), hist in sorted(histograms.items()):
+                if hist_name != name:
+                    continue
+                total = 0
+                for bound, count in zip(bounds, hist['buckets']):
+                    total += count
+                    samples.append(('_bucket', [('language', language), ('le', str(bound))], total))
+                samples.append(('_bucket', [('language', language), ('le', '+Inf')], hist['count']))
+                samples.append(('_sum', [('language', language)], hist['sum']))
+                samples.append(('_count', [('language', language)], hist['count']))
+            if samples:
+                lines += metric_family(name, 'histogram', samples)
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        histograms, counters = self._copy()
+        languages = collections.defaultdict(lambda: {'counters': {}, 'histograms': {}})
+        for (name, language, limit), value in counters.items():
+            section = languages[language]['counters']
+            if limit:
+                section.setdefault(name, {})[limit] = value
+            else:
+                section[name] = value
+        for (name, language), hist in histograms.items():
+            cumulative = list(itertools.accumulate(hist['buckets']))
+            languages[language]['histograms'][name] = {
+                'count': hist['count'],
+                'sum': hist['sum'],
+                'mean': hist['sum'] / hist['count'],
+                'buckets': dict(zip((str(b) for b in METRIC_BUCKETS[name]), cumulative), **{'+Inf': hist['count']}),
+            }
+        return dict(languages)
+
+_metrics = Metrics()
+
+def metrics_text():
+    lines = metric_family('inflight_executions', 'gauge', [('', [], _admission.inflight)])
+    lines += metric_family('pool_idle_workers', 'gauge',
+                           [('', [('language', language)], pool.idle.qsize()) for language, pool in _pools.items()])
+    stats = cache_stats()
+    if stats['enabled']:
+        lines += metric_family('cache_entries', 'gauge', [('', [], stats['entries'])])
+        lines += metric_family('cache_misses_total', 'counter', [('', [], stats['misses'])])
+    return _metrics.prometheus() + '\n'.join(lines) + '\n'
+
+PROFILE_COMMANDS = {
+    'python': lambda file, out: ['python3', '-m', 'cProfile', '-o', os.path.join(out, 'profile.pstats'), file],
+    'javascript': lambda file, out: ['node', '--cpu-prof', '--cpu-prof-dir', out, file],
+}
+
+PROFILE_LINES = int(os.environ.get('CODERUNNER_PROFILE_LINES', '40'))
+
+# Python profiles come back as pstats text sorted by cumulative time; Node
+# ones as the raw .cpuprofile JSON, which Chrome DevTools can load.
+def read_profile(language, profile_dir):
+    paths = glob.glob(os.path.join(profile_dir, '*'))
+    if not paths:
+        return None
+    try:
+        if language == 'python':
+            out = io.StringIO()
+            pstats.Stats(paths[0], stream=out).strip_dirs().sort_stats('cumulative').print_stats(PROFILE_LINES)
+            return out.getvalue()
+        with open(paths[0]) as f:
+            return f.read()
+    except (OSError, ValueError, TypeError, EOFError):
+        return None
+
+def run_profiled(language, path, stdin='', pass_fds=()):
+    with tempfile.TemporaryDirectory(prefix='coderunner-profile-', dir=WORKSPACE_ROOT) as profile_dir:
+        result = spawn(PROFILE_COMMANDS[language](path, profile_dir), stdin, pass_fds, limits_for(language))
+        result['profile'] = read_profile(language, profile_dir)
+    return result
+
+PREVIEW_SAMPLE = '''<h1>Heading</h1>
+<p>A paragraph with a <a href="#">link</a>, <strong>bold</strong> and <em>italic</em> text.</p>
+<ul><li>First item</li><li>Second item</li></ul>
+<button>Button</button>'''
+
+def preview_document(language, code):
+    if language == 'css':
+        return f'<!DOCTYPE html><html><head><style>{code}</style></head><body>{PREVIEW_SAMPLE}</body></html>'
+    return code
+
+class Asset:
+    def __init__(self, data, mimetype, compresslevel=9):
+        self.data = data
+        self.gzipped = gzip.compress(data, compresslevel)
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.etag = self.digest[:16]
+        self.mimetype = mimetype
+
+    def response(self, max_age, public=True):
+        if request.if_none_match.contains(self.etag):
+            resp = Response(status=304)
+        elif 'gzip' in request.headers.get('Accept-Encoding', '') and len(self.gzipped) < len(self.data):
+            resp = Response(self.gzipped, mimetype=self.mimetype)
+            resp.headers['Content-Encoding'] = 'gzip'
+        else:
+            resp = Response(self.data, mimetype=self.mimetype)
+        resp.set_etag(self.etag)
+        resp.headers['Vary'] = 'Accept-Encoding'
+        if public:
+            resp.cache_control.public = True
+        else:
+            resp.cache_control.private = True
+        resp.cache_control.max_age = max_age
+        return resp
+
+PREVIEW_BYTES = int(os.environ.get('CODERUNNER_PREVIEW_BYTES', str(32 * 1024 * 1024)))
+PREVIEW_DISK_BYTES = int(os.environ.get('CODERUNNER_PREVIEW_DISK_BYTES', str(256 * 1024 * 1024)))
+PREVIEW_DIR = os.environ.get('CODERUNNER_PREVIEW_DIR') or os.path.join(WORKSPACE_ROOT or tempfile.gettempdir(),
+                                                                         'coderunner-previews')
+
+# html/css are only ever rendered by the browser, so their preview document
+# is stored under its content hash and served from /preview/<key>.
+RENDER_ONLY_LANGUAGES = {'html', 'css'}
+
+HEX_DIGITS = set('0123456789abcdef')
+
+# An LRU of ready-to-serve assets in front of a directory of <sha256>.html
+# files. Keys are content hashes, so every server process can share the
+# directory: whichever one gets the iframe's GET finds the document.
+class PreviewStore:
+    def __init__(self, max_bytes=PREVIEW_BYTES, directory=PREVIEW_DIR, max_disk_bytes=PREVIEW_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.disk_bytes = 0
+        if directory:
+            try:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+                self.disk_bytes = sum(e.stat().st_size for e in os.scandir(directory) if e.name.endswith('.html'))
+            except OSError as e:
+                print(f"Previews kept in memory only: {e}", file=sys.stderr)
+                self.directory = None
+
+    def _remember(self, key, asset):
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = asset
+                self.size += len(asset.data) + len(asset.gzipped)
+            self.entries.move_to_end(key)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old.data) + len(old.gzipped)
+
+    def put(self, language, code):
+        data = preview_document(language, code).encode()
+        key = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return key
+        self._remember(key, Asset(data, 'text/html', compresslevel=6))
+        if self.directory:
+            path = os.path.join(self.directory, key + '.html')
+            if not os.path.exists(path):
+                tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+                try:
+                    with open(tmp, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp, path)
+                except OSError:
+                    with contextlib.suppress(OSError):
+                        os.remove(tmp)
+                    return key
+                with self.lock:
+                    self.disk_bytes += len(data)
+                    over = self.disk_bytes > self.max_disk_bytes
+                if over:
+                    self._evict_disk()
+        return key
+
+    def get(self, key):
+        with self.lock:
+            asset = self.entries.get(key)
+            if asset is not None:
+                self.entries.move_to_end(key)
+                return asset
+        if not self.directory or len(key) != 64 or not set(key) <= HEX_DIGITS:
+            return None
+        path = os.path.join(self.directory, key + '.html')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        asset = Asset(data, 'text/html', compresslevel=6)
+        self._remember(key, asset)
+        return asset
+
+    def _evict_disk(self):
+        # Least recently served or written first, down to 90%.
+        files = []
+        for e in os.scandir(self.directory):
+            if e.name.endswith('.html'):
+                with contextlib.suppress(OSError):
+                    st = e.stat()
+                    files.append((st.st_mtime, st.st_size, e.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_disk_bytes * 0.9:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                total -= size
+        with self.lock:
+            self.disk_bytes = total
+
+_previews = PreviewStore()
+
+def render_preview(language, code):
+    start = time.perf_counter()
+    key = _previews.put(language, code)
+    return {'stdout': '', 'stderr': '', 'returncode': 0, 'preview': key, 'wall_time': time.perf_counter() - start,
+            'cpu_time': None, 'max_rss_kb': None, 'limit': None}
+
+def execute(language, code, stdin='', use_cache=True, profile=False):
+    if language in RENDER_ONLY_LANGUAGES:
+        return render_preview(language, code)
+    # Profiled runs need the profiler's own command line, so they skip the
+    # pool and the cache.
+    if profile and language in PROFILE_COMMANDS:
+        # A real file name, so the profile says main.py rather than /dev/fd/N.
+        with source_file(language, code, named=True) as (path, fds):
+            result = run_profiled(language, path, stdin, fds)
+        _metrics.record(language, result)
+        return result
+    key = None
+    if _cache is not None and use_cache:
+        key = _cache.key(language, code, stdin)
+        hit = _cache.get(key)
+        if hit is not None:
+            _metrics.inc('cache_hits_total', language if language in LANG_COMMANDS else 'other')
+            return hit
+    pool = get_pool(language, stdin)
+    result = pool.run(code, stdin) if pool is not None else None
+    if result is None:
+        with source_file(language, code) as (path, fds):
+            result = spawn(LANG_COMMANDS.get(language, lambda f: ['cat', f])(path), stdin, fds, limits_for(language))
+    _metrics.record(language, result)
+    if key is not None:
+        _cache.put(key, result)
+    return result
+
+def run_file(language, file_path, stdin='', profile=False):
+    pool = get_pool(language, stdin)
+    result = None
+    if profile and language in PROFILE_COMMANDS:
+        result = run_profiled(language, file_path, stdin)
+    elif pool is not None:
+        with open(file_path) as f:
+            result = pool.run(f.read(), stdin, os.path.abspath(file_path))
+    if result is None:
+        result = spawn(LANG_COMMANDS.get(language, lambda f: ['cat', f])(file_path), stdin, limits=limits_for(language))
+    _metrics.record(language, result)
+    return result
+
+def print_result(result):
+    print(result['stdout'])
+    if result['stderr']:
+        print(result['stderr'], file=sys.stderr)
+    if result.get('limit'):
+        print(f"[stopped: {result['limit']} limit exceeded]", file=sys.stderr)
+
 def run_code(language, file_path):
     if language not in LANG_COMMANDS:
         print(f"Unsupported language: {language}")
         return
-    cmd = LANG_COMMANDS[language](file_path)
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        print(result.stdout)
-        if result.stderr:
-            print(result.stderr, file=sys.stderr)
+        print_result(run_file(language, file_path))
     except Exception as e:
         print(f"Error running code: {e}")
 
+def run_snippet(language, code):
+    if language not in LANG_COMMANDS:
+        print(f"Unsupported language: {language}")
+        return
+    # Nothing to run; print the document a browser would render.
+    if language in RENDER_ONLY_LANGUAGES:
+        print(preview_document(language, code))
+        return
+    try:
+        print_result(execute(language, code))
+    except Exception as e:
+        print(f"Error running code: {e}")
+
+LANG_BY_EXT = {ext: language for language, ext in EXT_MAP.items()}
+
+def batch_items(targets, language=None):
+    for target in targets:
+        if target.endswith('.jsonl') and os.path.isfile(target):
+            with open(target) as f:
+                for lineno, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        item = json.loads(line)
+                        if not isinstance(item, dict):
+                            raise ValueError('expected a JSON object')
+                    except ValueError as e:
+                        yield {'id': f'{target}:{lineno}', 'language': None, 'path': None, 'code': None,
+                               'stdin': '', 'expected': None, 'error': f'Invalid manifest line: {e}'}
+                        continue
+                    path = item.get('path')
+                    if path and not os.path.isabs(path):
+                        path = os.path.join(os.path.dirname(target), path)
+                    yield {
+                        'id': item.get('id', f'{target}:{lineno}'),
+                        'language': item.get('language') or language or LANG_BY_EXT.get(os.path.splitext(path or '')[1]),
+                        'path': path,
+                        'code': item.get('code'),
+                        'stdin': item.get('stdin', ''),
+                        'expected': item.get('expected'),
+                    }
+            continue
+        if os.path.isdir(target):
+            paths = sorted(os.path.join(root, name) for root, _, names in os.walk(target) for name in names)
+        else:
+            paths = sorted(glob.glob(target, recursive=True))
+        for path in paths:
+            lang = language or LANG_BY_EXT.get(os.path.splitext(path)[1])
+            if lang is not None:
+                yield {'id': path, 'language': lang, 'path': path, 'code': None, 'stdin': '', 'expected': None}
+
+def run_batch_item(item, profile=False):
+    language = item['language']
+    if item.get('error'):
+        result = {'stdout': '', 'stderr': item['error'], 'returncode': None}
+    elif language not in LANG_COMMANDS:
+        result = {'stdout': '', 'stderr': f'Unsupported language: {language}', 'returncode': None}
+    elif language in RENDER_ONLY_LANGUAGES:
+        result = {'stdout': '', 'stderr': '', 'returncode': None,
+                  'skipped': f'{language} is rendered by a browser, not run'}
+    else:
+        try:
+            if item['path']:
+                result = run_file(language, item['path'], item['stdin'], profile=profile)
+            else:
+                result = execute(language, item['code'] or '', item['stdin'], profile=profile)
+        except Exception as e:
+            result = {'stdout': '', 'stderr': f'Error running code: {e}', 'returncode': None}
+    record = {'id': item['id'], 'language': language, 'path': item['path']}
+    record.update((k, v) for k, v in result.items() if k != 'cmd')
+    record.setdefault('cpu_time', None)
+    record.setdefault('max_rss_kb', None)
+    if item['expected'] is not None and 'skipped' not in result:
+        record['passed'] = result['stdout'].rstrip() == item['expected'].rstrip()
+    return record
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='coderunner.py batch', description='Run many files or snippets in parallel.',
+        epilog='Every record has cpu_time and max_rss_kb (null when unknown). Pooled javascript runs '
+               'share a node process, so their max_rss_kb is that worker\'s peak so far; use --no-pool for '
+               'per-run figures.')
+    parser.add_argument('targets', nargs='+', help='directories, glob patterns or .jsonl manifests')
+    parser.add_argument('--language', help='language for every target instead of inferring it from the extension')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help='parallel runs (default: core count)')
+    parser.add_argument('--output', '-o', help='write JSONL results here instead of stdout')
+    parser.add_argument('--no-pool', action='store_true', help='spawn a fresh interpreter for every run')
+    parser.add_argument('--stats', help='write per-language timing histograms and counters here as JSON')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile each python/javascript run and include it in its result')
+    args = parser.parse_args(argv)
+
+    if not args.no_pool:
+        start_pools(size=args.jobs)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    runs = passed = graded = skipped = 0
+    start = time.perf_counter()
+    # Every run is its own child process; the threads only wait on pipes.
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_batch_item, item, args.profile) for item in batch_items(args.targets, args.language)]
+        for future in as_completed(futures):
+            record = future.result()
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            if 'skipped' in record:
+                skipped += 1
+                continue
+            runs += 1
+            if 'passed' in record:
+                graded += 1
+                passed += record['passed']
+    elapsed = time.perf_counter() - start
+    if out is not sys.stdout:
+        out.close()
+    stop_pools()
+    summary = f"{runs} runs in {elapsed:.2f}s ({runs / elapsed if elapsed else 0:.1f} runs/sec, {args.jobs} jobs)"
+    if graded:
+        summary += f", {passed}/{graded} passed"
+    if skipped:
+        summary += f", {skipped} html/css skipped"
+    print(summary, file=sys.stderr)
+    if args.stats:
+        stats = {'runs': runs, 'elapsed': elapsed, 'runs_per_sec': runs / elapsed if elapsed else 0,
+                 'jobs': args.jobs, 'cache': cache_stats(), 'languages': _metrics.snapshot()}
+        with open(args.stats, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+QUEUE_LIMIT = int(os.environ.get('CODERUNNER_QUEUE_LIMIT', '64'))
+
+class Overloaded(Exception):
+    pass
+
+# Counts executions that are running or waiting for a worker; past the
+# limit new work is refused with a 503 instead of piling up.
+class Admission:
+    def __init__(self, limit=QUEUE_LIMIT):
+        self.limit = limit
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            if self.limit and self.inflight >= self.limit:
+                raise Overloaded(f'{self.inflight} executions in flight')
+            self.inflight += 1
+
+    def release(self):
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+
+    def drain(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.inflight == 0, timeout)
+
+_admission = Admission()
+
+JOB_RETENTION = int(os.environ.get('CODERUNNER_JOB_RETENTION', '300'))
+
+class Job:
+    def __init__(self, language, code, stdin=''):
+        self.id = uuid.uuid4().hex
+        self.language = language
+        self.code = code
+        self.stdin = stdin
+        self.limits = limits_for(language)
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+        self.returncode = None
+        self.limit = None
+        self.cpu_time = None
+        self.max_rss_kb = None
+        self.preview = None
+        self.done = False
+        self.submitted_at = time.perf_counter()
+        self.finished_at = None
+        self.cond = threading.Condition()
+
+    def append(self, stream, text):
+        with self.cond:
+            if self.truncated:
+                return
+            room = self.limits['output'] - self.size if self.limits.get('output') else len(text)
+            if len(text) > room:
+                text = text[:room]
+                self.truncated = True
+            if text:
+                self.chunks.append((stream, text))
+                self.size += len(text)
+            if self.truncated:
+                self.chunks.append(('stderr', TRUNCATION_MARKER))
+            self.cond.notify_all()
+
+    def finish(self, returncode, limit=None, usage=None):
+        with self.cond:
+            self.returncode = returncode
+            self.limit = limit
+            if usage is not None:
+                self.cpu_time = usage.ru_utime + usage.ru_stime
+                self.max_rss_kb = usage.ru_maxrss
+            self.done = True
+            self.finished_at = time.monotonic()
+            self.cond.notify_all()
+
+    def events(self, start=0):
+        index = start
+        while True:
+            with self.cond:
+                while index >= len(self.chunks) and not self.done:
+                    self.cond.wait()
+                chunks = self.chunks[index:]
+                done = self.done
+            for chunk in chunks:
+                yield index, chunk
+                index += 1
+            if done and index >= len(self.chunks):
+                return
+
+    def status(self):
+        with self.cond:
+            return {
+                'id': self.id,
+                'language': self.language,
+                'done': self.done,
+                'returncode': self.returncode,
+                'limit': self.limit,
+                'truncated': self.truncated,
+                'cpu_time': self.cpu_time,
+                'max_rss_kb': self.max_rss_kb,
+                'preview': self.preview,
+                'stdout': ''.join(text for stream, text in self.chunks if stream == 'stdout'),
+                'stderr': ''.join(text for stream, text in self.chunks if stream == 'stderr'),
+            }
+
+# One event loop multiplexes the pipes of every running job. Streaming jobs
+# always spawn a fresh process since pooled workers only report on exit.
+class Supervisor:
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def submit(self, language, code, stdin='', use_cache=True):
+        job = Job(language, code, stdin)
+        key = None
+        if language in RENDER_ONLY_LANGUAGES:
+            job.preview = _previews.put(language, code)
+            job.finish(0)
+        elif _cache is not None and use_cache:
+            key = _cache.key(language, code, stdin)
+            hit = _cache.get(key)
+            if hit is not None:
+                job.append('stdout', hit['stdout'])
+                job.append('stderr', hit['stderr'])
+                job.finish(hit['returncode'])
+                _metrics.inc('cache_hits_total', language if language in LANG_COMMANDS else 'other')
+        if not job.done:
+            _admission.acquire()
+        with self.lock:
+            self._prune()
+            self.jobs[job.id] = job
+        if job.done:
+            return job
+        asyncio.run_coroutine_threadsafe(self._run(job, key), self.loop)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.monotonic() - JOB_RETENTION
+        for job_id in [j.id for j in self.jobs.values() if j.done and j.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    async def _pump(self, stream, job, name, pid):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            data = await stream.read(4096)
+            if not data:
+                job.append(name, decoder.decode(b'', final=True))
+                return
+            job.append(name, decoder.decode(data))
+            if job.truncated:
+                kill_group(pid)
+
+    async def _reader(self, pipe):
+        reader = asyncio.StreamReader()
+        await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader
+
+    # Waits for the process to exit without reaping it, so _reap() can
+    # collect its rusage with wait4() as spawn() does.
+    async def _exited(self, pid):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        if pidfd is not None:
+            ready = self.loop.create_future()
+            self.loop.add_reader(pidfd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                self.loop.remove_reader(pidfd)
+                os.close(pidfd)
+            return
+        while True:
+            try:
+                if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+                    return
+            except ChildProcessError:
+                return
+            await asyncio.sleep(0.01)
+
+    async def _reap(self, proc):
+        await self._exited(proc.pid)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        return proc.returncode, usage
+
+    # The child is started with plain Popen and reaped here rather than by
+    # asyncio's child watcher, which would discard its rusage.
+    async def _run(self, job, key=None):
+        returncode = limit = spawn_time = usage = None
+        limits = job.limits
+        start = time.perf_counter()
+        try:
+            with source_file(job.language, job.code) as (path, fds):
+                argv, options = launch(LANG_COMMANDS.get(job.language, lambda f: ['cat', f])(path), limits, fds)
+                proc = subprocess.Popen(argv, **options)
+                spawn_time = time.perf_counter() - start
+                if job.stdin:
+                    stdin, _ = await self.loop.connect_write_pipe(asyncio.Protocol, proc.stdin)
+                    stdin.write(job.stdin.encode())
+                    stdin.close()
+                else:
+                    proc.stdin.close()
+                pumps = asyncio.gather(self._pump(await self._reader(proc.stdout), job, 'stdout', proc.pid),
+                                       self._pump(await self._reader(proc.stderr), job, 'stderr', proc.pid))
+
+                # As in collect(): the run ends when the program exits, and
+                # one deadline covers the output and the exit.
+                reaped = []
+
+                async def complete():
+                    reaped.append(await self._reap(proc))
+                    kill_group(proc.pid)
+                    await pumps
+
+                try:
+                    await asyncio.wait_for(complete(), limits.get('timeout') or None)
+                except asyncio.TimeoutError:
+                    limit = 'timeout'
+                    kill_group(proc.pid)
+                    if not reaped:
+                        reaped.append(await self._reap(proc))
+                    pumps.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await pumps
+                returncode, usage = reaped[0]
+        except Exception as e:
+            job.append('stderr', f'Error: {e}')
+        finally:
+            cpu_time = usage.ru_utime + usage.ru_stime if usage is not None else None
+            if limit is None and job.truncated:
+                limit = 'output'
+            if limit is None:
+                limit = breached_limit(returncode, job.status()['stderr'], limits, cpu_time)
+            job.finish(returncode, limit, usage)
+            _admission.release()
+        status = job.status()
+        _metrics.record(job.language, dict(status, queue_wait=start - job.submitted_at, spawn_time=spawn_time,
+                                           wall_time=time.perf_counter() - start))
+        if key is not None:
+            _cache.put(key, status)
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+def get_supervisor():
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = Supervisor()
+        return _supervisor
+
 HTML = '''
 <!DOCTYPE html>
 <html lang="en">
@@ -41,12 +1508,12 @@ HTML = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Code Runner</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    <link rel="stylesheet" href="{{ css_url }}">
 </head>
 <body class="bg-gray-100 min-h-screen flex items-center justify-center">
     <div class="bg-white shadow-lg rounded-lg p-8 w-full max-w-2xl">
         <h2 class="text-3xl font-bold mb-6 text-center text-blue-600">Code Runner</h2>
-        <form method="post" class="space-y-4">
+        <form method="post" id="runForm" class="space-y-4">
             <div>
                 <label for="language" class="block font-semibold mb-1">Language:</label>
                 <select name="language" id="language" class="w-full p-2 border rounded">
@@ -62,6 +1529,18 @@ HTML = '''
                 <label for="code" class="block font-semibold mb-1">Code:</label>
                 <textarea name="code" id="code" rows="10" class="w-full p-2 border rounded font-mono">{% if code %}{{ code }}{% endif %}</textarea>
             </div>
+            <div>
+                <label class="inline-flex items-center space-x-2">
+                    <input type="checkbox" name="no_cache" value="1" {% if no_cache %}checked{% endif %}>
+                    <span>Always re-run (code uses time, randomness or the network)</span>
+                </label>
+            </div>
+            <div>
+                <label class="inline-flex items-center space-x-2">
+                    <input type="checkbox" name="profile" id="profile" value="1" {% if profile %}checked{% endif %}>
+                    <span>Profile the run (Python and JavaScript)</span>
+                </label>
+            </div>
             <button type="submit" class="w-full bg-blue-600 text-white py-2 rounded hover:bg-blue-700 font-bold">Run</button>
         </form>
         <div class="mt-8">
@@ -71,22 +1550,25 @@ HTML = '''
             </div>
             <div id="outputPanel">
                 {# Running Command box hidden #}
-                {% if output %}
-                <div>
+                <div id="outputBox" {% if not output %}style="display:none;"{% endif %}>
                     <h3 class="text-xl font-semibold mb-2 text-green-700">Output:</h3>
-                    <pre class="bg-gray-900 text-green-300 p-4 rounded overflow-x-auto">{{ output }}</pre>
+                    <pre id="output" class="bg-gray-900 text-green-300 p-4 rounded overflow-x-auto">{{ output }}</pre>
+                </div>
+                {% if profile_output %}
+                <div class="mt-8">
+                    <h3 class="text-xl font-semibold mb-2 text-green-700">Profile:</h3>
+                    <pre class="bg-gray-900 text-green-300 p-4 rounded overflow-x-auto">{{ profile_output }}</pre>
                 </div>
                 {% endif %}
             </div>
             <div id="previewPanel" style="display:none;">
                 <h3 class="text-xl font-semibold mb-2 text-purple-700">Preview:</h3>
-                {% if language in ['html', 'css'] and preview %}
-                    <iframe srcdoc="{{ preview|safe }}" class="w-full h-64 border rounded"></iframe>
-                {% elif preview %}
-                    <pre class="bg-gray-900 text-purple-300 p-4 rounded overflow-x-auto">{{ preview }}</pre>
-                {% else %}
-                    <div class="text-gray-500">No code to preview.</div>
+                <iframe id="previewFrame" class="w-full h-64 border rounded" sandbox="allow-scripts"
+                        {% if preview_url %}src="{{ preview_url }}"{% else %}style="display:none;"{% endif %}></iframe>
+                {% if preview and not preview_url %}
+                    <pre id="previewCode" class="bg-gray-900 text-purple-300 p-4 rounded overflow-x-auto">{{ preview }}</pre>
                 {% endif %}
+                <div id="previewEmpty" class="text-gray-500" {% if preview %}style="display:none;"{% endif %}>No code to preview.</div>
             </div>
         </div>
     </div>
@@ -107,45 +1589,366 @@ HTML = '''
             }
         }
         showTab('output');
+
+        // html/css only need their preview document, not the whole page.
+        function showPreview(form) {
+            fetch('/preview', { method: 'POST', body: new FormData(form) })
+                .then(function (resp) { return resp.json(); })
+                .then(function (data) {
+                    var frame = document.getElementById('previewFrame');
+                    var code = document.getElementById('previewCode');
+                    frame.src = data.url;
+                    frame.style.display = 'block';
+                    if (code) {
+                        code.style.display = 'none';
+                    }
+                    document.getElementById('previewEmpty').style.display = 'none';
+                    showTab('preview');
+                });
+        }
+
+        // Stream program output from the job API; browsers without
+        // EventSource fall back to the plain form post.
+        document.getElementById('runForm').addEventListener('submit', function (e) {
+            var language = document.getElementById('language').value;
+            if (!window.fetch) {
+                return;
+            }
+            if (language === 'html' || language === 'css') {
+                e.preventDefault();
+                showPreview(this);
+                return;
+            }
+            // Profiles come back with the finished run, so use the form post.
+            if (!window.EventSource || document.getElementById('profile').checked) {
+                return;
+            }
+            e.preventDefault();
+            var output = document.getElementById('output');
+            output.textContent = '';
+            document.getElementById('outputBox').style.display = 'block';
+            showTab('output');
+            fetch('/jobs', { method: 'POST', body: new FormData(this) })
+                .then(function (resp) { return resp.json(); })
+                .then(function (job) {
+                    var source = new EventSource(job.stream);
+                    ['stdout', 'stderr'].forEach(function (name) {
+                        source.addEventListener(name, function (ev) { output.textContent += JSON.parse(ev.data); });
+                    });
+                    source.addEventListener('exit', function (ev) {
+                        var info = JSON.parse(ev.data);
+                        if (info.limit) {
+                            output.textContent += '\n[stopped: ' + info.limit + ' limit exceeded]';
+                        }
+                        source.close();
+                    });
+                })
+                .catch(function (err) { output.textContent = 'Error: ' + err; });
+        });
     </script>
 </body>
 </html>
 '''
 
-def flask_app():
-    app = Flask(__name__)
+# The handful of Tailwind utilities the page uses, so the browser no longer
+# fetches and JIT-compiles Tailwind on every load.
+CSS = '''
+*,::before,::after{box-sizing:border-box;border:0 solid #e5e7eb}
+html{line-height:1.5;font-family:ui-sans-serif,system-ui,-apple-system,"Segoe UI",Roboto,"Helvetica Neue",Arial,sans-serif}
+body{margin:0;line-height:inherit}
+h2,h3{font-size:inherit;font-weight:inherit;margin:0}
+pre,.font-mono{font-family:ui-monospace,SFMono-Regular,Menlo,Monaco,Consolas,"Liberation Mono",monospace}
+pre{margin:0}
+button,input,select,textarea{font-family:inherit;font-size:100%;line-height:inherit;color:inherit;margin:0}
+button{background-color:transparent;background-image:none;cursor:pointer;padding:0}
+textarea{resize:vertical}
+iframe{display:block}
+.block{display:block}
+.flex{display:flex}
+.inline-flex{display:inline-flex}
+.items-center{align-items:center}
+.justify-center{justify-content:center}
+.space-y-4>:not([hidden])~:not([hidden]){margin-top:1rem}
+.space-x-2>:not([hidden])~:not([hidden]){margin-left:.5rem}
+.min-h-screen{min-height:100vh}
+.w-full{width:100%}
+.max-w-2xl{max-width:42rem}
+.h-64{height:16rem}
+.overflow-x-auto{overflow-x:auto}
+.rounded{border-radius:.25rem}
+.rounded-lg{border-radius:.5rem}
+.border{border-width:1px}
+.border-b{border-bottom-width:1px}
+.border-b-2{border-bottom-width:2px}
+.border-transparent{border-color:transparent}
+.border-blue-600{border-color:#2563eb}
+.bg-white{background-color:#fff}
+.bg-gray-100{background-color:#f3f4f6}
+.bg-gray-900{background-color:#111827}
+.bg-blue-600{background-color:#2563eb}
+.p-2{padding:.5rem}
+.p-4{padding:1rem}
+.p-8{padding:2rem}
+.px-4{padding-left:1rem;padding-right:1rem}
+.py-2{padding-top:.5rem;padding-bottom:.5rem}
+.mb-1{margin-bottom:.25rem}
+.mb-2{margin-bottom:.5rem}
+.mb-4{margin-bottom:1rem}
+.mb-6{margin-bottom:1.5rem}
+.mt-8{margin-top:2rem}
+.text-center{text-align:center}
+.text-xl{font-size:1.25rem;line-height:1.75rem}
+.text-3xl{font-size:1.875rem;line-height:2.25rem}
+.font-semibold{font-weight:600}
+.font-bold{font-weight:700}
+.text-white{color:#fff}
+.text-gray-500{color:#6b7280}
+.text-gray-600{color:#4b5563}
+.text-green-300{color:#86efac}
+.text-green-700{color:#15803d}
+.text-purple-300{color:#d8b4fe}
+.text-purple-700{color:#7e22ce}
+.text-blue-600{color:#2563eb}
+.shadow-lg{box-shadow:0 10px 15px -3px rgb(0 0 0/.1),0 4px 6px -4px rgb(0 0 0/.1)}
+.hover\\:bg-blue-700:hover{background-color:#1d4ed8}
+.focus\\:outline-none:focus{outline:2px solid transparent;outline-offset:2px}
+'''
+
+PORT = int(os.environ.get('CODERUNNER_PORT', '6767'))
+
+def create_app():
+    app = Flask(__name__, static_folder=None)
+    # Compiled once here instead of on every render_template_string() call.
+    page = app.jinja_env.from_string(HTML)
+    # Fingerprinted names let browsers cache assets for a year.
+    assets = {}
+    css = Asset(CSS.encode(), 'text/css')
+    assets[f'app.{css.etag}.css'] = css
+    css_url = f'/static/app.{css.etag}.css'
+
+    @app.errorhandler(Overloaded)
+    def overloaded(e):
+        return jsonify(error='server busy, retry shortly'), 503, {'Retry-After': '1'}
 
     @app.route('/', methods=['GET', 'POST'])
     def index():
         output = ''
         cmd_str = ''
         preview = ''
+        preview_url = ''
         language = ''
         code = ''
+        no_cache = False
+        profile = False
+        profile_output = ''
         if request.method == 'POST':
             language = request.form['language']
             code = request.form['code']
-            ext = EXT_MAP.get(language, '.txt')
-            temp_file = f'temp_code{ext}'
-            with open(temp_file, 'w') as f:
-                f.write(code)
-            cmd = LANG_COMMANDS.get(language, lambda f: ['cat', f])(temp_file)
-            cmd_str = ' '.join(cmd)
+            no_cache = bool(request.form.get('no_cache'))
+            profile = bool(request.form.get('profile'))
+            _admission.acquire()
             try:
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                output = result.stdout + (('\n' + result.stderr) if result.stderr else '')
+                result = execute(language, code, use_cache=not no_cache, profile=profile)
+                profile_output = result.get('profile') or ''
+                cmd_str = ' '.join(result.get('cmd', []))
+                output = result['stdout'] + (('\n' + result['stderr']) if result['stderr'] else '')
+                if result.get('limit'):
+                    output += f"\n[stopped: {result['limit']} limit exceeded]"
+                if result.get('preview'):
+                    preview_url = url_for('preview_page', key=result['preview'])
                 preview = code
             except Exception as e:
                 output = f'Error: {e}'
             finally:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-        return render_template_string(HTML, output=output, cmd=cmd_str, preview=preview, language=language, code=code)
+                _admission.release()
+        return page.render(output=output, cmd=cmd_str, preview=preview, language=language, code=code,
+                           no_cache=no_cache, css_url=css_url, preview_url=preview_url, profile=profile,
+                           profile_output=profile_output)
 
-    app.run(host='0.0.0.0', port=6767, debug=True)
+    @app.route('/static/<name>')
+    def static_asset(name):
+        asset = assets.get(name)
+        if asset is None:
+            return jsonify(error='not found'), 404
+        resp = asset.response(365 * 24 * 3600)
+        resp.cache_control.immutable = True
+        return resp
+
+    @app.route('/preview', methods=['POST'])
+    def store_preview():
+        data = request.get_json(silent=True) or request.form
+        language = data.get('language', '')
+        if language not in RENDER_ONLY_LANGUAGES:
+            return jsonify(error=f'no preview for {language!r}'), 400
+        key = _previews.put(language, data.get('code', ''))
+        return jsonify(key=key, url=url_for('preview_page', key=key)), 201
+
+    @app.route('/preview/<key>')
+    def preview_page(key):
+        asset = _previews.get(key)
+        if asset is None:
+            return jsonify(error='preview expired'), 404
+        # Content-addressed, so a given URL never changes.
+        resp = asset.response(365 * 24 * 3600, public=False)
+        resp.cache_control.immutable = True
+        # Opened directly, the page still gets an opaque origin rather than ours.
+        resp.headers['Content-Security-Policy'] = 'sandbox allow-scripts'
+        return resp
+
+    @app.route('/jobs', methods=['POST'])
+    def submit_job():
+        data = request.get_json(silent=True) or request.form
+        language = data.get('language', '')
+        code = data.get('code', '')
+        no_cache = str(data.get('no_cache', '')).lower() in ('1', 'true', 'on')
+        job = get_supervisor().submit(language, code, data.get('stdin', ''), use_cache=not no_cache)
+        return jsonify(id=job.id, status=url_for('job_status', job_id=job.id),
+                       stream=url_for('job_stream', job_id=job.id)), 202
+
+    @app.route('/cache')
+    def cache():
+        return jsonify(cache_stats())
+
+    # Counts are per process: with several gunicorn workers each scrape
+    # reaches whichever worker accepts it.
+    @app.route('/metrics')
+    def metrics():
+        return Response(metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @app.route('/jobs/<job_id>')
+    def job_status(job_id):
+        job = get_supervisor().get(job_id)
+        if job is None:
+            return jsonify(error='unknown job'), 404
+        status = job.status()
+        if status['preview']:
+            status['preview'] = url_for('preview_page', key=status['preview'])
+        return jsonify(status)
+
+    @app.route('/jobs/<job_id>/stream')
+    def job_stream(job_id):
+        job = get_supervisor().get(job_id)
+        if job is None:
+            return jsonify(error='unknown job'), 404
+        start = request.headers.get('Last-Event-ID', '')
+        start = int(start) + 1 if start.isdigit() else 0
+
+        def events():
+            for index, (stream, text) in job.events(start):
+                yield f'id: {index}\nevent: {stream}\ndata: {json.dumps(text)}\n\n'
+            done = {'returncode': job.returncode, 'limit': job.limit, 'truncated': job.truncated,
+                    'cpu_time': job.cpu_time, 'max_rss_kb': job.max_rss_kb}
+            if job.preview:
+                done['preview'] = url_for('preview_page', key=job.preview)
+            yield f'event: exit\ndata: {json.dumps(done)}\n\n'
+
+        return Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    return app
+
+def flask_app():
+    app = create_app()
+    start_pools()
+    # The reloader would spawn a second copy of every pool in its watcher process.
+    app.run(host='0.0.0.0', port=PORT, debug=True, use_reloader=False, threaded=True)
+
+def shutdown(grace):
+    if not _admission.drain(grace):
+        print(f"Shutdown: {_admission.inflight} executions still running after {grace}s", file=sys.stderr)
+    stop_pools()
+
+def serve_gunicorn(app, args):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for name, value in self.options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return app
+
+    # Pools and the job supervisor are per-process, so they start after fork.
+    Server({
+        'bind': f'{args.host}:{args.port}',
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'keepalive': args.keepalive,
+        'graceful_timeout': args.graceful_timeout,
+        'backlog': args.backlog,
+        'post_fork': lambda server, worker: start_pools(),
+        'worker_exit': lambda server, worker: shutdown(args.graceful_timeout),
+    }).run()
+
+def serve_werkzeug(app, args):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    # HTTP/1.1 keeps connections alive between requests; the socket timeout
+    # closes them once idle for the keep-alive period.
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    WSGIRequestHandler.timeout = args.keepalive
+    server = make_server(args.host, args.port, app, threaded=True)
+    # Non-daemon request threads let server_close() wait for them to finish.
+    server.daemon_threads = False
+    server.block_on_close = True
+    start_pools()
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Serving on http://{args.host}:{args.port} (werkzeug, threaded)", file=sys.stderr)
+    server.serve_forever()
+    server.server_close()
+    shutdown(args.graceful_timeout)
+
+def serve_main(argv):
+    env = os.environ.get
+    parser = argparse.ArgumentParser(prog='coderunner.py serve', description='Serve Code Runner for production use.')
+    parser.add_argument('--host', default=env('CODERUNNER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=int(env('CODERUNNER_WORKERS', '1')),
+                        help='worker processes; job streams are served by the process that started them, '
+                             'so the job API needs sticky routing with more than one (previews are shared '
+                             'through CODERUNNER_PREVIEW_DIR)')
+    parser.add_argument('--threads', type=int, default=int(env('CODERUNNER_THREADS', '32')),
+                        help='request threads per worker process')
+    parser.add_argument('--queue-limit', type=int, default=QUEUE_LIMIT,
+                        help='executions running or waiting per process before answering 503 (0: unlimited)')
+    parser.add_argument('--keepalive', type=int, default=int(env('CODERUNNER_KEEPALIVE', '5')),
+                        help='seconds to hold idle keep-alive connections')
+    parser.add_argument('--graceful-timeout', type=int, default=int(env('CODERUNNER_GRACEFUL_TIMEOUT', '30')),
+                        help='seconds to drain in-flight executions on shutdown')
+    parser.add_argument('--backlog', type=int, default=int(env('CODERUNNER_BACKLOG', '2048')),
+                        help='pending connections the listening socket holds (gunicorn only)')
+    parser.add_argument('--server', choices=['auto', 'gunicorn', 'werkzeug'], default=env('CODERUNNER_SERVER', 'auto'))
+    args = parser.parse_args(argv)
+
+    _admission.limit = args.queue_limit
+    app = create_app()
+    if args.server == 'werkzeug':
+        serve_werkzeug(app, args)
+        return
+    if importlib.util.find_spec('gunicorn') is None:
+        if args.server == 'gunicorn':
+            raise SystemExit('gunicorn is not installed (pip install gunicorn)')
+        print("gunicorn not installed; falling back to the threaded werkzeug server", file=sys.stderr)
+        serve_werkzeug(app, args)
+        return
+    serve_gunicorn(app, args)
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve_main(sys.argv[2:])
+    elif len(sys.argv) == 3:
         lang = sys.argv[1].lower()
         file_path = sys.argv[2]
         run_code(lang, file_path)
@@ -162,9 +1965,4 @@ if __name__ == "__main__":
                 break
             code_lines.append(line)
         code = '\n'.join(code_lines)
-        ext = EXT_MAP.get(lang, '.txt')
-        temp_file = f'temp_code{ext}'
-        with open(temp_file, 'w') as f:
-            f.write(code)
-        run_code(lang, temp_file)
-        os.remove(temp_file)
+        run_snippet(lang, code)